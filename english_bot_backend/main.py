@@ -1,11 +1,19 @@
 # main.py
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from langdetect import detect, LangDetectException
+from langdetect import LangDetectException
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
 import google.generativeai as genai
-import os, re, time, random, unicodedata, json
+import orjson
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+import asyncio, os, re, time, unicodedata
 
 # ===================== CONFIG =====================
 load_dotenv()
@@ -13,23 +21,104 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 ENV_MODEL = os.getenv("GEMINI_MODEL_NAME", "").strip()
 
 if GEMINI_API_KEY:
+    # sem transport explícito: o SDK já usa gRPC (grpc_asyncio no cliente async), com um canal persistente
     genai.configure(api_key=GEMINI_API_KEY)
     GEMINI_MODEL_NAME = ENV_MODEL or "gemini-1.5-flash"
+    GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL_NAME)  # criado uma vez e reutilizado
 else:
     GEMINI_MODEL_NAME = ""  # sem chave -> modo offline
+    GEMINI_MODEL = None
 
-app = FastAPI(title="English WhatsApp Bot", version="1.0.0")
+# aquece no boot o que a primeira mensagem pagaria: o langdetect e o canal com o Gemini.
+# count_tokens usa o mesmo cliente do generate_content_async e não gasta cota de geração.
+WARMUP_TIMEOUT_SECONDS = 5
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"],
-)
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    safe_detect_lang("hello, how are you today?")
+    if GEMINI_MODEL is not None:
+        try:
+            await asyncio.wait_for(GEMINI_MODEL.count_tokens_async("ping"), timeout=WARMUP_TIMEOUT_SECONDS)
+        except Exception:
+            pass  # sem rede no boot não impede o serviço de subir
+    yield
+
+# produção: python main.py (ver o fim do arquivo) ou uvicorn main:app --loop uvloop --http httptools
+app = FastAPI(title="English WhatsApp Bot", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# CORS em ASGI puro: só acrescenta os cabeçalhos no http.response.start e responde o preflight
+# (OPTIONS) direto com 204, sem tocar no corpo. Sem credenciais. ALLOWED_ORIGINS="*" (padrão) libera
+# qualquer origem com um cabeçalho fixo; uma lista separada por vírgula ecoa só as origens dela.
+ALLOWED_ORIGINS = tuple(o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",") if o.strip())
+
+class LiteCORSMiddleware:
+    def __init__(self, app, allow_origins: tuple[str, ...] = ("*",)):
+        self.app = app
+        self.allow_any = "*" in allow_origins
+        self.allowed = frozenset(o.encode("latin-1") for o in allow_origins)
+        self.any_origin_headers = [(b"access-control-allow-origin", b"*")]
+        self.preflight_extra = [
+            (b"access-control-allow-methods", b"*"),
+            (b"access-control-allow-headers", b"*"),
+            (b"access-control-max-age", b"600"),
+        ]
+
+    def _cors_headers(self, scope) -> list[tuple[bytes, bytes]]:
+        if self.allow_any:
+            return self.any_origin_headers
+        origin = next((v for k, v in scope["headers"] if k == b"origin"), None)
+        if origin in self.allowed:
+            return [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        return [(b"vary", b"Origin")]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        cors_headers = self._cors_headers(scope)
+        if scope["method"] == "OPTIONS" and any(k == b"access-control-request-method" for k, _ in scope["headers"]):
+            await send({"type": "http.response.start", "status": 204, "headers": cors_headers + self.preflight_extra})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(LiteCORSMiddleware, allow_origins=ALLOWED_ORIGINS)
+# respostas longas do Gemini (aulas, explicações) vão comprimidas; as curtas não valem o custo do gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 # ===================== ESTADO =====================
-user_memory: dict[str, dict] = {}
-last_quota_error_at = 0.0
+# LRU + TTL por telefone: os usuários inativos há mais tempo saem quando passa do limite,
+# e quem ficou parado mais que USER_MEMORY_TTL_SECONDS é descartado
+USER_MEMORY_MAX_USERS = 10_000
+USER_MEMORY_TTL_SECONDS = 24 * 3600
+MAX_STORED_REPLY_CHARS = 4096  # teto do last_ai_reply guardado por usuário
+MAX_USER_TEXT_CHARS = 1000  # mensagem maior que isso é cortada antes de virar prompt (custo e latência do Gemini)
+user_memory: OrderedDict[str, dict] = OrderedDict()
+quota_blocked_until = 0.0  # time.monotonic() até quando o Gemini fica em pausa após erro de cota
 USER_COOLDOWN_SECONDS = 6
+QUOTA_BACKOFF_SECONDS = 30
+
+def get_memory(phone: str) -> dict:
+    now = time.monotonic()
+    # a ordem do LRU é a de último acesso: os expirados estão todos no começo
+    while user_memory and now - next(iter(user_memory.values()))["seen_at"] >= USER_MEMORY_TTL_SECONDS:
+        user_memory.popitem(last=False)
+    memory = user_memory.get(phone)
+    if memory is None:
+        memory = user_memory[phone] = {}
+        if len(user_memory) > USER_MEMORY_MAX_USERS:
+            user_memory.popitem(last=False)
+    else:
+        user_memory.move_to_end(phone)
+    memory["seen_at"] = now
+    return memory
 
 # ===================== MODELOS/PAYLOADS =====================
 class Message(BaseModel):
@@ -48,80 +137,198 @@ class WhatsAppMessage(BaseModel):
 QUOTA_FRIENDLY_REPLY_PT = "⚠️ Bati no limite gratuito diário da IA por agora. Tente de novo mais tarde. 🙏"
 QUOTA_FRIENDLY_REPLY_EN = "⚠️ I just hit today’s free AI quota. Please try again later. 🙏"
 
+# Tabela de tradução montada uma vez: letra acentuada -> letra base (via NFD) e marcas combinantes
+# soltas -> removidas. Cobre Latin-1/Extended/Additional; str.translate roda inteiro em C.
+def _build_accent_map() -> dict[int, str | None]:
+    table: dict[int, str | None] = {}
+    for cp in range(0x80, 0x2000):
+        ch = chr(cp)
+        if unicodedata.category(ch) == 'Mn':
+            table[cp] = None
+            continue
+        base = ''.join(c for c in unicodedata.normalize('NFD', ch) if unicodedata.category(c) != 'Mn')
+        if base != ch:
+            table[cp] = base
+    return table
+
+ACCENT_MAP = _build_accent_map()
+
 def _unaccent(s: str) -> str:
-    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+    return s.translate(ACCENT_MAP)
+
+# O bot só distingue PT x EN: carrega apenas esses dois perfis do langdetect (em vez dos 55),
+# o que reduz memória/tempo de import e faz o cálculo de probabilidade rodar sobre 2 classes.
+DETECT_LANGS = ("pt", "en")
+
+def _build_lang_factory() -> DetectorFactory:
+    profiles = []
+    for code in DETECT_LANGS:
+        with open(os.path.join(PROFILES_DIRECTORY, code), encoding="utf-8") as f:
+            profiles.append(f.read())
+    factory = DetectorFactory()
+    factory.load_json_profile(profiles)
+    factory.set_seed(0)
+    return factory
+
+LANG_FACTORY = _build_lang_factory()
 
+# til e cedilha praticamente só aparecem em português entre os dois idiomas que o bot atende
+PT_ONLY_CHARS_RE = re.compile(r"[ãõçÃÕÇ]")
+
+@lru_cache(maxsize=4096)
 def safe_detect_lang(text: str) -> str:
+    if PT_ONLY_CHARS_RE.search(text):
+        return "pt"
     try:
-        return detect(text)
+        detector = LANG_FACTORY.create()
+        detector.append(text)
+        return detector.detect()
     except (LangDetectException, Exception):
         return "pt"
 
+# os marcadores de cota aparecem no começo da mensagem de erro do Gemini: basta olhar os primeiros
+# QUOTA_SCAN_CHARS, sem copiar a resposta inteira com .lower()
+QUOTA_RE = re.compile(r" 429 |exceeded your current quota|rate limits", re.IGNORECASE)
+QUOTA_SCAN_CHARS = 512
+
 def is_quota_error_text(text: str) -> bool:
-    t = (text or "").lower()
-    return " 429 " in t or "exceeded your current quota" in t or "rate limits" in t
+    return QUOTA_RE.search(text or "", 0, QUOTA_SCAN_CHARS) is not None
+
+JSON_FENCE_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL)
+
+# cache prompt -> resposta (TTL + LRU): mensagens repetidas não gastam cota do Gemini
+AI_CACHE_TTL_SECONDS = 3600
+AI_CACHE_MAX_ITEMS = 5_000
+ai_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+def ai_cache_get(prompt: str) -> str | None:
+    hit = ai_cache.get(prompt)
+    if hit is None:
+        return None
+    expires_at, text = hit
+    if expires_at < time.monotonic():
+        del ai_cache[prompt]
+        return None
+    ai_cache.move_to_end(prompt)
+    return text
 
-def model_generate_text(prompt: str) -> str:
-    if not GEMINI_API_KEY or not GEMINI_MODEL_NAME:
-        return "⚠️ (modo offline) GEMINI_API_KEY ausente."
+def ai_cache_put(prompt: str, text: str) -> None:
+    ai_cache[prompt] = (time.monotonic() + AI_CACHE_TTL_SECONDS, text)
+    ai_cache.move_to_end(prompt)
+    if len(ai_cache) > AI_CACHE_MAX_ITEMS:
+        ai_cache.popitem(last=False)
+
+# prompts idênticos em voo ao mesmo tempo compartilham uma única chamada ao Gemini (single-flight)
+ai_inflight: dict[str, asyncio.Task] = {}
+# teto de chamadas simultâneas ao Gemini neste processo; o excedente espera a vez em vez de estourar a cota
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+async def _gemini_call(prompt: str) -> str:
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-        resp = model.generate_content(prompt)
+        # versão assíncrona do SDK: o event loop segue atendendo outras requisições durante a chamada
+        async with gemini_slots:
+            resp = await GEMINI_MODEL.generate_content_async(prompt)
         text = getattr(resp, "text", "") or ""
-        if text.strip().startswith("```json"):
-            match = re.search(r"```json\s*(\{.*?\})\s*```", text, re.DOTALL)
-            if match:
-                return match.group(1).strip()
-        return text.strip() if text else "(sem resposta do modelo)"
     except Exception as e:
         return f"⚠️ Erro ao consultar o modelo: {str(e)}"
+    if not text:
+        return "(sem resposta do modelo)"
+    result = text.strip()
+    if result.startswith("```json"):
+        match = JSON_FENCE_RE.search(text)
+        if match:
+            result = match.group(1).strip()
+    if result and not is_quota_error_text(result):
+        ai_cache_put(prompt, result)
+    return result
+
+async def model_generate_text(prompt: str) -> str:
+    if GEMINI_MODEL is None:
+        return "⚠️ (modo offline) GEMINI_API_KEY ausente."
+    cached = ai_cache_get(prompt)
+    if cached is not None:
+        return cached
+    task = ai_inflight.get(prompt)
+    if task is None:
+        task = asyncio.ensure_future(_gemini_call(prompt))
+        ai_inflight[prompt] = task
+        task.add_done_callback(lambda _: ai_inflight.pop(prompt, None))
+    # shield: se um dos clientes desconectar, a chamada compartilhada continua para os outros
+    return await asyncio.shield(task)
+
+# saudação e/ou rótulo "Motivação:" no início de linha, removidos numa única passada
+_HEADER_MOTIVATION = r"\*?\s*motiv[aá]?[cç][aã]o\s*\*?\s*:\s*"
+REPLY_HEADERS_RE = re.compile(
+    r"(?im)^\s*(?:(?:ol[áa]|oi|hello|hi|hey)[!,.…]*\s*(?:" + _HEADER_MOTIVATION + r")?|" + _HEADER_MOTIVATION + r")"
+)
 
 def strip_headers(text: str) -> str:
-    text = re.sub(r"(?im)^\s*(ol[áa]|oi|hello|hi|hey)[!,.…]*\s*", "", text).strip()
-    text = re.sub(r"(?im)^\s*\*?\s*motiv[aá]?[cç][aã]o\s*\*?\s*:\s*", "", text).strip()
-    return text
+    return REPLY_HEADERS_RE.sub("", text).strip()
 
-def can_call_ai(memory: dict) -> bool:
-    now = time.time()
-    last_user = memory.get("last_call_ts", 0.0)
-    global last_quota_error_at
-    return (now - last_user) >= USER_COOLDOWN_SECONDS and (now - last_quota_error_at) >= 30
+# Verifica e já reserva a vaga do usuário no mesmo passo (sem await no meio, então é atômico no
+# event loop): duas mensagens simultâneas do mesmo telefone não passam as duas pelo cooldown.
+def try_reserve_ai_call(memory: dict) -> bool:
+    now = time.monotonic()
+    if now < quota_blocked_until or now < memory.get("next_ai_at", 0.0):
+        return False
+    memory["next_ai_at"] = now + USER_COOLDOWN_SECONDS
+    return True
+
+def block_ai_for_quota() -> None:
+    global quota_blocked_until
+    quota_blocked_until = time.monotonic() + QUOTA_BACKOFF_SECONDS
 
 # ===================== DETECÇÃO E EXTRAÇÃO =====================
-QUOTED_RE = re.compile(r'["“”\'‘’\u201c\u201d](.+?)["“”\'‘’\u201c\u201d]', re.DOTALL)
+# classe negada: varre até a próxima aspa sem backtracking; trechos citados limitados a 500 chars
+QUOTED_RE = re.compile(r'["“”\'‘’]([^"“”\'‘’]{1,500})["“”\'‘’]')
+# marcadores ("essa frase está correta: ...") compilados numa única alternação
+SENTENCE_MARKERS = [
+    "essa frase esta correta", "esta correto", "nao entendi essa frase",
+    "is this sentence correct", "please correct", "explain this sentence", "what does it mean"
+]
+SENTENCE_MARKERS_RE = re.compile("|".join(re.escape(mk) for mk in SENTENCE_MARKERS))
+
+SHORT_TEXT_LEN = 8  # abaixo disso o n-grama do langdetect não ajuda; decide só pela heurística
 
 def looks_english(s: str) -> bool:
     s = s.strip()
     if not s: return False
-    lang = safe_detect_lang(s)
-    if lang == "en": return True
-    letters = sum(ch.isalpha() for ch in s)
-    if letters < 3: return False
-    ascii_letters = sum(ch.isascii() and ch.isalpha() for ch in s)
-    return ascii_letters >= letters * 0.8
-
-def extract_english_sentence(user_text: str) -> str | None:
+    # map(str.isalpha) conta sem montar lista nem rodar genexpr; as letras ASCII são as que
+    # sobram depois de descartar o que não é ASCII
+    letters = sum(map(str.isalpha, s))
+    if letters >= 3:
+        if s.isascii(): return True  # toda letra já é ASCII: razão = 1
+        if sum(map(str.isalpha, s.encode("ascii", "ignore").decode())) >= letters * 0.8: return True
+    # langdetect só quando a contagem de letras não decide
+    return len(s) >= SHORT_TEXT_LEN and safe_detect_lang(s) == "en"
+
+def extract_english_sentence(user_text: str, low: str | None = None) -> str | None:
     m = QUOTED_RE.search(user_text)
     if m and looks_english(m.group(1)):
         return m.group(1).strip()
     lines = [ln.strip() for ln in user_text.splitlines() if ln.strip()]
     if lines and looks_english(lines[-1]):
         return lines[-1]
-    low = _unaccent(user_text.lower())
-    for mk in [
-        "essa frase esta correta", "esta correto", "nao entendi essa frase",
-        "is this sentence correct", "please correct", "explain this sentence", "what does it mean"
-    ]:
-        if mk in low:
-            after = user_text[low.find(mk)+len(mk):].strip(" :.-\n\t")
-            if looks_english(after):
-                return after
+    if low is None:
+        low = _unaccent(user_text.lower())
+    for mk in SENTENCE_MARKERS_RE.finditer(low):
+        after = user_text[mk.end():].strip(" :.-\n\t")
+        if looks_english(after):
+            return after
     return None
 
 # ===================== INTENTS (CLASSIFICADOR) =====================
+# chit-chat separado por idioma da resposta; "ok" não decide sozinho (fica em pt, o idioma padrão do bot)
+CHIT_CHAT_KEYWORDS = {
+    "pt": ["obrigado", "valeu", "blz", "beleza"],
+    "en": ["thanks", "thank you", "cool", "nice"],
+    "any": ["ok"],
+}
+
 INTENT_KEYWORDS = {
     "greeting": ["bom dia", "boa tarde", "boa noite", "oi", "ola", "hello", "hi", "hey", "good morning", "good afternoon", "good evening"],
-    "chit_chat": ["obrigado", "valeu", "ok", "blz", "beleza", "thanks", "thank you", "cool", "nice"],
+    "chit_chat": [kw for kws in CHIT_CHAT_KEYWORDS.values() for kw in kws],
     "correction": ["corrigir", "corrige", "esta correto", "is this correct", "please correct", "essa frase esta correta"],
     "explain_sentence": ["nao entendi", "explica", "significa", "quer dizer", "what does it mean", "explain this"],
     "question": ["o que", "qual", "como", "quando", "diferença", "what", "how", "why", "difference"],
@@ -137,40 +344,95 @@ TOPIC_KEYWORDS = {
     "since vs for": ["since", "for", "diferenca since for"],
 }
 
-def classify_intent_by_rules(user_text: str) -> tuple[str | None, str | None]:
-    t_norm = _unaccent(user_text.lower()).strip()
+# Tópicos, perguntas e chit-chat exigem palavra inteira ("do" não casa em "obrigado", "ok" em "book");
+# explain_sentence/correction continuam por prefixo ("explica" → "explicação").
+# as palavras-chave são comparadas com o texto já normalizado, então também são normalizadas
+# (uma vez, no import) — senão "diferença" nunca casaria com "diferenca"
+INTENT_KEYWORDS_NORM = {intent: tuple(_unaccent(kw.lower()) for kw in kws) for intent, kws in INTENT_KEYWORDS.items()}
+TOPIC_KEYWORDS_NORM = {topic: tuple(_unaccent(kw.lower()) for kw in kws) for topic, kws in TOPIC_KEYWORDS.items()}
+
+SCANNED_INTENTS = ("explain_sentence", "correction", "question", "chit_chat")
+GREETINGS = frozenset(INTENT_KEYWORDS_NORM["greeting"])  # saudação é por igualdade exata: lookup O(1)
+_CHIT_CHAT_ALT = "|".join(re.escape(kw) for kw in sorted(INTENT_KEYWORDS_NORM["chit_chat"], key=len, reverse=True))
+CHIT_CHAT_ONLY_RE = re.compile(r"[\W_]*(?:(?:" + _CHIT_CHAT_ALT + r")\b[\W_]*)+")
+CHIT_CHAT_WORD_RE = re.compile(r"\b(?:" + _CHIT_CHAT_ALT + r")\b")
+# no caminho rápido o idioma vem da própria palavra: o langdetect erra justamente em "ok"/"valeu"
+CHIT_CHAT_LANG = {_unaccent(kw.lower()): lang for lang, kws in CHIT_CHAT_KEYWORDS.items() for kw in kws}
+
+def chit_chat_lang(t_norm: str) -> str:
+    langs = {CHIT_CHAT_LANG[kw] for kw in CHIT_CHAT_WORD_RE.findall(t_norm)}
+    return "en" if "en" in langs and "pt" not in langs else "pt"
+
+WHOLE_WORD_INTENTS = frozenset({"question", "chit_chat"})
+
+def _is_whole_word(t: str, start: int, end: int) -> bool:
+    return (start == 0 or not t[start - 1].isalnum()) and (end == len(t) or not t[end].isalnum())
+
+# `kw in t` (busca em C) filtra quase tudo; só quando a palavra aparece é que se olha a fronteira
+def _has_keyword(t: str, kw: str, whole_word: bool) -> bool:
+    if kw not in t:
+        return False
+    if not whole_word:
+        return True
+    start = t.find(kw)
+    while start != -1:
+        if _is_whole_word(t, start, start + len(kw)):
+            return True
+        start = t.find(kw, start + 1)
+    return False
+
+# primeiro tópico na ordem de TOPIC_KEYWORDS
+def match_topic(t_norm: str) -> str | None:
+    for topic, kws in TOPIC_KEYWORDS_NORM.items():
+        for kw in kws:
+            if _has_keyword(t_norm, kw, True):
+                return topic
+    return None
+
+def keyword_hits(t_norm: str) -> set[str]:
+    return {
+        intent for intent in SCANNED_INTENTS
+        if any(_has_keyword(t_norm, kw, intent in WHOLE_WORD_INTENTS) for kw in INTENT_KEYWORDS_NORM[intent])
+    }
 
-    if t_norm in INTENT_KEYWORDS["greeting"]:
+# `text_norm` é o _unaccent(user_text.lower()) calculado uma vez por requisição
+def classify_intent_by_rules(user_text: str, text_norm: str) -> tuple[str | None, str | None]:
+    t_norm = text_norm.strip()
+
+    if t_norm in GREETINGS:
         return "greeting", t_norm
 
-    if t_norm == "#resetar":
-        return "reset", None
+    # caminho rápido: mensagem feita só de agradecimento/ok ("valeu!", "ok, obrigado") vira chit-chat
+    # antes da extração de frase em inglês (que roda o langdetect); o conteúdo já leva o idioma
+    if CHIT_CHAT_ONLY_RE.fullmatch(t_norm):
+        return "chit_chat", chit_chat_lang(t_norm)
 
     if ("reexplica" in t_norm or "explica de novo" in t_norm) and ("resposta" in t_norm or "acima" in t_norm):
         return "reexplain_last", None
 
-    for topic, kws in TOPIC_KEYWORDS.items():
-        for k in kws:
-            if _unaccent(k) in t_norm:
-                return "topic_lesson", topic
+    topic = match_topic(t_norm)
+    if topic:
+        return "topic_lesson", topic
+
+    hits = keyword_hits(t_norm)
 
-    eng_sentence = extract_english_sentence(user_text)
+    eng_sentence = extract_english_sentence(user_text, text_norm)
     if eng_sentence:
-        if any(kw in t_norm for kw in INTENT_KEYWORDS["explain_sentence"]):
+        if "explain_sentence" in hits:
             return "explain_sentence", eng_sentence
         return "correction", eng_sentence
     
     # Adicionado para pegar casos como "Essa frase está correta? She go to school"
-    if any(kw in t_norm for kw in INTENT_KEYWORDS["correction"]):
+    if "correction" in hits:
         return "correction", user_text
 
-    if "?" in t_norm or any(kw in t_norm for kw in INTENT_KEYWORDS["question"]):
+    if "?" in t_norm or "question" in hits:
         return "question", user_text
 
     if looks_english(user_text):
         return "correction", user_text
 
-    if any(kw in t_norm for kw in INTENT_KEYWORDS["chit_chat"]):
+    if "chit_chat" in hits:
         return "chit_chat", None
 
     return None, None
@@ -194,8 +456,27 @@ LESSONS_PT = {
     ),
 }
 
+# tópicos conhecidos sem aula fixa: a explicação do Gemini é gerada uma vez e reaproveitada sem expirar
+# (limitado pelo número de chaves de TOPIC_KEYWORDS)
+LEARNED_LESSONS_PT: dict[str, str] = {}
+
 # ===================== RESPOSTAS NATURAIS =====================
-def greeting_reply(greeting_text: str) -> str:
+GREETING_PREFIXES = ("oi", "ola", "hello", "hi", "hey")  # startswith com tupla: uma checagem só, em C
+GREETING_REPLIES = ("Olá! 👋", "Oi, tudo bem?", "Hello! How can I help you today?")
+CHIT_CHAT_REPLIES_PT = (
+    "👍 Certo!",
+    "Qualquer outra dúvida, é só chamar! 😉",
+    "Disponha! Se precisar de mais alguma coisa, estou aqui.",
+)
+CHIT_CHAT_REPLIES_EN = ("You're welcome!", "Sure thing!", "Anytime! Let me know if you need anything else.")
+
+# rodízio por usuário (índice guardado na memória dele) no lugar de random.choice
+def _next_reply(pool: tuple[str, ...], memory: dict) -> str:
+    idx = memory.get("reply_idx", 0)
+    memory["reply_idx"] = (idx + 1) % len(pool)
+    return pool[idx % len(pool)]
+
+def greeting_reply(greeting_text: str, memory: dict) -> str:
     greeting_text = _unaccent(greeting_text.lower())
     if "bom dia" in greeting_text:
         return "Bom dia! Tudo bem? 😊"
@@ -203,28 +484,32 @@ def greeting_reply(greeting_text: str) -> str:
         return "Boa tarde! Como vai? ✨"
     if "boa noite" in greeting_text:
         return "Boa noite! Espero que tenha tido um ótimo dia. 🌙"
-    if any(s in greeting_text for s in ["oi", "ola", "hello", "hi", "hey"]):
-        return random.choice(["Olá! 👋", "Oi, tudo bem?", "Hello! How can I help you today?"])
+    if greeting_text.startswith(GREETING_PREFIXES):
+        return _next_reply(GREETING_REPLIES, memory)
     return "Olá! 😊"
 
-def chit_chat_reply(lang: str) -> str:
+def chit_chat_reply(lang: str, memory: dict) -> str:
     if lang.startswith("pt"):
-        return random.choice([
-            "👍 Certo!",
-            "Qualquer outra dúvida, é só chamar! 😉",
-            "Disponha! Se precisar de mais alguma coisa, estou aqui."
-        ])
+        return _next_reply(CHIT_CHAT_REPLIES_PT, memory)
     else:
-        return random.choice(["You're welcome!", "Sure thing!", "Anytime! Let me know if you need anything else."])
+        return _next_reply(CHIT_CHAT_REPLIES_EN, memory)
 
 # ===================== PROMPTS COMPLETOS =====================
 
-def prompt_router_ai(user_message: str) -> str:
+# classifica e já responde na mesma chamada: o caminho ambíguo gasta um Gemini em vez de dois
+def prompt_router_ai(user_message: str, level: str) -> str:
     return (
-        "Você é um assistente que classifica a intenção de um aluno de inglês. Responda APENAS com um objeto JSON.\n"
+        "Você é um professor de inglês que classifica a intenção de um aluno e já responde. Responda APENAS com um objeto JSON.\n"
         "Categorias de intenção: `correction`, `question`, `explain_sentence`, `greeting`, `chit_chat`.\n"
         "IMPORTANTE: Se a mensagem for APENAS uma saudação simples como 'oi', 'bom dia', 'hello', classifique como `greeting`.\n"
-        "No JSON, inclua 'intent' e 'content' (a frase ou o tópico principal da pergunta).\n"
+        "No JSON, inclua 'intent', 'content' (a frase ou o tópico principal da pergunta) e 'reply'.\n"
+        "Em 'reply', para `correction`, `question` e `explain_sentence`, escreva a resposta ao aluno no idioma da mensagem "
+        "(PT-BR se ele escreveu em português), curta e sem saudação:\n"
+        "- correction: linhas *Correção:*, *Explicação:* e *Dica:* (ou *Correction:*, *Explanation:*, *Tip:* em inglês).\n"
+        "- question: explicação clara com 1-2 exemplos.\n"
+        "- explain_sentence: tradução, vocabulário chave e 1 ponto gramatical.\n"
+        "Para `greeting` e `chit_chat`, deixe 'reply' vazio.\n"
+        f"Nível do aluno: {level}\n"
         f"Mensagem do aluno: \"{user_message}\"\n\n"
         "```json\n"
     )
@@ -291,107 +576,192 @@ def prompt_reexplain_pt(text_to_explain: str) -> str:
     )
 
 # ===================== ENDPOINTS BÁSICOS =====================
+# corpos estáticos serializados uma vez só. "/" pode ser cacheado por 60s; "/health" é a sonda que o
+# bridge usa para acordar/checar o backend, então nunca pode vir de cache
+ROOT_BODY = orjson.dumps({"message": "OLÁ, MUNDO!", "service": "English WhatsApp Bot"})
+ROOT_HEADERS = {"Cache-Control": "public, max-age=60"}
+HEALTH_BODY = orjson.dumps({"status": "ok"})
+HEALTH_HEADERS = {"Cache-Control": "no-store"}
+
 @app.get("/")
-def root():
-    return {"message": "OLÁ, MUNDO!", "service": "English WhatsApp Bot"}
+async def root():
+    return Response(content=ROOT_BODY, media_type="application/json", headers=ROOT_HEADERS)
 
 @app.get("/health")
-def health():
-    return {"status": "ok"}
+async def health():
+    return Response(content=HEALTH_BODY, media_type="application/json", headers=HEALTH_HEADERS)
 
 # ===================== LÓGICA PRINCIPAL (REFINADA) =====================
-@app.post("/correct")
-async def correct_english(message: Message):
-    global last_quota_error_at
-    user_text = (message.user_message or "").strip()
+def _cmd_reset(phone: str) -> str:
+    user_memory.pop(phone, None)
+    return "🔄 Memória resetada. Bora recomeçar!"
+
+# comandos exatos: resolvidos antes de qualquer detecção de idioma/classificação
+COMMANDS = {
+    "#resetar": _cmd_reset,
+}
+
+# estado de uma mensagem já classificada, repassado aos handlers de intenção
+@dataclass
+class Turn:
+    user_text: str
+    text_norm: str
+    content: str | None
+    level: str
+    memory: dict
+    ai_reserved: bool = False
+
+    # idioma detectado só quando algum handler precisa (saudação/aula pronta não roda langdetect)
+    @cached_property
+    def lang_msg(self) -> str:
+        return safe_detect_lang(self.user_text)
+
+    @property
+    def is_en(self) -> bool:
+        return self.lang_msg.startswith("en")
+
+def _quota_reply(turn: Turn) -> str:
+    return QUOTA_FRIENDLY_REPLY_EN if turn.is_en else QUOTA_FRIENDLY_REPLY_PT
+
+def _remember(turn: Turn, reply: str) -> str:
+    turn.memory["last_ai_reply"] = reply[:MAX_STORED_REPLY_CHARS]
+    return reply
+
+# parte comum de toda resposta via IA: cooldown -> modelo -> cota -> limpeza -> memória
+async def _ai_reply(turn: Turn, prompt: str) -> str:
+    # resposta já em cache não gasta Gemini, então não passa pelo cooldown nem pela pausa de cota
+    text = ai_cache_get(prompt) if GEMINI_MODEL is not None else None
+    if text is not None:
+        return _remember(turn, strip_headers(text))
+    # a vaga pode já ter sido reservada nesta mesma mensagem pela chamada do roteador
+    if not (turn.ai_reserved or try_reserve_ai_call(turn.memory)) or time.monotonic() < quota_blocked_until:
+        return _quota_reply(turn)
+    text = await model_generate_text(prompt)
+    if is_quota_error_text(text):
+        block_ai_for_quota()
+        reply = _quota_reply(turn)
+    else:
+        reply = strip_headers(text)
+    if reply:
+        _remember(turn, reply)
+    return reply
+
+async def _reply_greeting(turn: Turn) -> str:
+    return _remember(turn, greeting_reply(turn.content or turn.user_text, turn.memory))
+
+async def _reply_chit_chat(turn: Turn) -> str:
+    # idioma já decidido pelo caminho rápido do classificador; nos demais casos, langdetect
+    lang = turn.content if turn.content in ("pt", "en") else turn.lang_msg
+    return _remember(turn, chit_chat_reply(lang, turn.memory))
+
+async def _reply_reexplain_last(turn: Turn) -> str:
+    last_ai = turn.memory.get("last_ai_reply", "")
+    if not last_ai:
+        return _remember(turn, "Não achei a última explicação. 🙂")
+    return await _ai_reply(turn, prompt_reexplain_pt(last_ai))
+
+async def _reply_topic_lesson(turn: Turn) -> str:
+    topic = turn.content
+    lesson = LESSONS_PT.get(topic) or LEARNED_LESSONS_PT.get(topic)
+    if lesson:
+        return _remember(turn, lesson)
+    prompt = prompt_question_pt(topic or turn.user_text)
+    reply = await _ai_reply(turn, prompt)
+    # só guarda quando a resposta veio de fato do modelo (erros e cota não entram no cache de prompts)
+    if topic in TOPIC_KEYWORDS and ai_cache_get(prompt) is not None:
+        LEARNED_LESSONS_PT[topic] = reply
+    return reply
+
+async def _reply_explain_sentence(turn: Turn) -> str:
+    return await _ai_reply(turn, prompt_explain_sentence_pt(turn.content or turn.user_text))
+
+async def _reply_question(turn: Turn) -> str:
+    question = turn.content or turn.user_text
+    return await _ai_reply(turn, prompt_question_en(question) if turn.is_en else prompt_question_pt(question))
+
+async def _reply_correction(turn: Turn) -> str:
+    # <<< MUDANÇA: Garante que a frase a ser corrigida seja extraída corretamente.
+    sentence = extract_english_sentence(turn.user_text, turn.text_norm) or (
+        turn.content if turn.content and looks_english(turn.content) else turn.user_text
+    )
+    # espaços colapsados: a mesma frase digitada com espaçamento diferente cai no mesmo prompt (e no cache)
+    sentence = " ".join(sentence.split())
+    prompt = prompt_correction_en(turn.level, sentence) if turn.is_en else prompt_correction_pt(turn.level, sentence)
+    return await _ai_reply(turn, prompt)
+
+async def _reply_default(turn: Turn) -> str:
+    return await _ai_reply(turn, prompt_question_pt(turn.user_text))
+
+INTENT_HANDLERS: dict[str, Callable[[Turn], Awaitable[str]]] = {
+    "greeting": _reply_greeting,
+    "chit_chat": _reply_chit_chat,
+    "reexplain_last": _reply_reexplain_last,
+    "topic_lesson": _reply_topic_lesson,
+    "explain_sentence": _reply_explain_sentence,
+    "question": _reply_question,
+    "correction": _reply_correction,
+}
+
+# intenções que o roteador já responde no campo "reply"; as demais têm resposta local
+ROUTER_ANSWERED_INTENTS = frozenset({"correction", "question", "explain_sentence"})
+
+# núcleo compartilhado por /correct e pelo webhook; devolve só o texto da resposta
+async def handle_user_message(user_text: str, phone: str, level: str) -> str:
+    user_text = (user_text or "").strip()
     if not user_text:
         raise HTTPException(status_code=400, detail="Texto vazio.")
+    user_text = user_text[:MAX_USER_TEXT_CHARS]
 
-    phone = message.phone
-    memory = user_memory.setdefault(phone, {})
-    lang_msg = safe_detect_lang(user_text)
+    command = COMMANDS.get(user_text.lower())
+    if command:
+        return command(phone)
+
+    memory = get_memory(phone)
 
     # --- 1. CLASSIFICAR INTENÇÃO ---
-    intent, content = classify_intent_by_rules(user_text)
+    text_norm = _unaccent(user_text.lower())
+    intent, content = classify_intent_by_rules(user_text, text_norm)
 
+    ai_reserved = False
+    router_reply = None
     if not intent:
-        if not can_call_ai(memory): return {"reply": QUOTA_FRIENDLY_REPLY_PT}
-        
-        router_response_str = model_generate_text(prompt_router_ai(user_text))
+        router_prompt = prompt_router_ai(user_text, level)
+        # roteamento já em cache não gasta Gemini: como em _ai_reply, não reserva a vaga do usuário
+        router_response_str = ai_cache_get(router_prompt) if GEMINI_MODEL is not None else None
+        if router_response_str is None:
+            if not try_reserve_ai_call(memory): return QUOTA_FRIENDLY_REPLY_PT
+            ai_reserved = True
+            router_response_str = await model_generate_text(router_prompt)
+        if is_quota_error_text(router_response_str):
+            block_ai_for_quota()
+            return QUOTA_FRIENDLY_REPLY_PT
         try:
-            router_data = json.loads(router_response_str)
+            router_data = orjson.loads(router_response_str)
             intent = router_data.get("intent", "question")
             content = router_data.get("content", user_text)
-        except (json.JSONDecodeError, TypeError):
+            router_reply = router_data.get("reply")
+        except (orjson.JSONDecodeError, TypeError, AttributeError):
             intent = "question"
             content = user_text
+        # o JSON vem do modelo: lista/objeto em "intent" quebraria o lookup (unhashable) -> vira question
+        if not isinstance(intent, str):
+            intent = "question"
+        if not isinstance(content, str):
+            content = user_text
     
-    # --- 2. EXECUTAR AÇÃO COM BASE NA INTENÇÃO ---
-    reply = ""
-    use_ai = False
-    prompt = ""
-
-    if intent == "reset":
-        user_memory.pop(phone, None)
-        reply = "🔄 Memória resetada. Bora recomeçar!"
-    
-    elif intent == "greeting":
-        reply = greeting_reply(content or user_text)
-
-    elif intent == "chit_chat":
-        reply = chit_chat_reply(lang_msg)
-
-    elif intent == "reexplain_last":
-        last_ai = memory.get("last_ai_reply", "")
-        if not last_ai:
-            reply = "Não achei a última explicação. 🙂"
-        else:
-            use_ai = True
-            prompt = prompt_reexplain_pt(last_ai)
-            
-    elif intent == "topic_lesson":
-        if content and content in LESSONS_PT:
-            reply = LESSONS_PT[content]
-        else:
-            use_ai = True
-            prompt = prompt_question_pt(content or user_text)
-
-    elif intent == "explain_sentence":
-        use_ai = True
-        prompt = prompt_explain_sentence_pt(content or user_text)
-
-    elif intent == "question":
-        use_ai = True
-        prompt = prompt_question_pt(content or user_text) if not lang_msg.startswith("en") else prompt_question_en(content or user_text)
-
-    elif intent == "correction":
-        use_ai = True
-        # <<< MUDANÇA: Garante que a frase a ser corrigida seja extraída corretamente.
-        sentence_to_correct = extract_english_sentence(user_text) or (content if looks_english(content) else user_text)
-        prompt = prompt_correction_pt(message.level, sentence_to_correct) if not lang_msg.startswith("en") else prompt_correction_en(message.level, sentence_to_correct)
+    # --- 2. EXECUTAR O HANDLER DA INTENÇÃO ---
+    turn = Turn(user_text, text_norm, content, level, memory, ai_reserved)
+    # resposta que já veio junto com a classificação; sem ela (ou se era só saudação), cai no handler
+    if intent in ROUTER_ANSWERED_INTENTS and isinstance(router_reply, str):
+        router_reply = strip_headers(router_reply)
+        if router_reply:
+            return _remember(turn, router_reply)
+    reply = await INTENT_HANDLERS.get(intent, _reply_default)(turn)
+    return reply or "Não entendi sua mensagem, pode tentar de outra forma?"
 
-    else:
-        use_ai = True
-        prompt = prompt_question_pt(user_text)
-
-    # --- 3. PROCESSAR RESPOSTA (SE USAR IA) ---
-    if use_ai:
-        if not can_call_ai(memory):
-            return {"reply": QUOTA_FRIENDLY_REPLY_PT if not lang_msg.startswith('en') else QUOTA_FRIENDLY_REPLY_EN}
-        text = model_generate_text(prompt)
-        if is_quota_error_text(text):
-            last_quota_error_at = time.time()
-            reply = QUOTA_FRIENDLY_REPLY_PT if not lang_msg.startswith('en') else QUOTA_FRIENDLY_REPLY_EN
-        else:
-            reply = strip_headers(text)
-
-    # --- 4. ATUALIZAR MEMÓRIA E RETORNAR ---
-    if reply:
-        memory["last_ai_reply"] = reply
-        if use_ai:
-            memory["last_call_ts"] = time.time()
-            
-    return {"reply": reply or "Não entendi sua mensagem, pode tentar de outra forma?"}
+@app.post("/correct")
+async def correct_english(message: Message):
+    return {"reply": await handle_user_message(message.user_message, message.phone, message.level)}
 
 # ===================== UTILIDADES =====================
 @app.post("/resetar")
@@ -401,6 +771,22 @@ async def resetar_memoria(req: ResetReq):
 
 @app.post("/whatsapp/webhook")
 async def whatsapp_webhook(msg: WhatsAppMessage):
-    payload = Message(user_message=msg.body, phone=msg.from_number)
-    result = await correct_english(payload)
-    return {"to": msg.from_number, "reply": result.get("reply", "")}
\ No newline at end of file
+    reply = await handle_user_message(msg.body, msg.from_number, "basic")
+    return {"to": msg.from_number, "reply": reply}
+
+# python main.py: sobe o uvicorn já com uvloop + httptools. WEB_CONCURRENCY > 1 abre mais workers, mas
+# cada um tem sua própria memória de usuários, cooldowns e caches (no plano free, deixe 1).
+# Com 1 worker passa o próprio `app` (sem reimportar o módulo); com vários, o uvicorn exige a string de
+# import, que depende do diretório atual e de como o arquivo foi chamado.
+if __name__ == "__main__":
+    import uvicorn
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        app if workers == 1 else f"{__spec__.name if __spec__ else 'main'}:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        loop="auto",  # uvloop/httptools quando instalados (uvicorn[standard] no Linux); asyncio/h11 no Windows
+        http="auto",
+        timeout_keep_alive=30,
+    )